@@ -0,0 +1,82 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+Contains an optional C implementation of the sampling loop in
+:mod:`normal.py`. For small samples, the cost of calling into numpy several
+times per draw outweighs the cost of the arithmetic itself. This module
+draws the sample and accumulates its averages in one loop, without holding
+the GIL.
+
+This extension is optional. :mod:`normal.py` uses it if it has been built,
+and falls back to numpy otherwise. To build it in place, run
+
+.. sourcecode:: bash
+
+    CFLAGS="-I$(python -c 'import numpy; print(numpy.get_include())')" \
+        cythonize -i _normal_c.pyx
+
+from this directory. The numpy headers are needed for the bit generator
+declarations.
+"""
+import numpy as np
+from libc.math cimport log, sqrt
+from cpython.pycapsule cimport PyCapsule_IsValid, PyCapsule_GetPointer
+from numpy.random cimport bitgen_t
+
+cdef const char *capsule_name = "BitGenerator"
+
+
+def sample_and_reduce(
+        bit_generator, double mean, double standard_deviation,
+        double[::1] out
+):
+    """
+    Fills ``out`` with samples drawn from the normal distribution, and
+    returns the sample together with its average and the average of its
+    squares. Standard normal values are generated with the polar method,
+    using both values of each pair, from the uniform doubles produced by
+    ``bit_generator``.
+
+    :param bit_generator: The numpy bit generator to draw from
+    :param float mean: The mean of the distribution to be sampled
+    :param float standard_deviation: The standard deviation of the
+        distribution to be sampled
+    :param out: A contiguous array of doubles to write the sample into
+    :return: The sample, its average, and the average of its squares
+    :rtype: tuple
+    """
+    cdef bitgen_t *rng
+    cdef Py_ssize_t i = 0
+    cdef Py_ssize_t n = out.shape[0]
+    cdef double x1, x2, r2, f, x
+    cdef double sum_x = 0.0
+    cdef double sum_x2 = 0.0
+
+    capsule = bit_generator.capsule
+    if not PyCapsule_IsValid(capsule, capsule_name):
+        raise ValueError('Invalid bit generator capsule')
+    rng = <bitgen_t *> PyCapsule_GetPointer(capsule, capsule_name)
+
+    with bit_generator.lock, nogil:
+        while i < n:
+            while True:
+                x1 = 2.0 * rng.next_double(rng.state) - 1.0
+                x2 = 2.0 * rng.next_double(rng.state) - 1.0
+                r2 = x1 * x1 + x2 * x2
+                if r2 < 1.0 and r2 != 0.0:
+                    break
+            f = standard_deviation * sqrt(-2.0 * log(r2) / r2)
+
+            x = mean + f * x1
+            out[i] = x
+            sum_x += x
+            sum_x2 += x * x
+            i += 1
+
+            if i < n:
+                x = mean + f * x2
+                out[i] = x
+                sum_x += x
+                sum_x2 += x * x
+                i += 1
+
+    return np.asarray(out), sum_x / n, sum_x2 / n
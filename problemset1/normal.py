@@ -10,33 +10,155 @@ This file can be used directly from the command line using
     pydev normal.py 1 2 10
 
 where ``1`` is the mean, ``2`` is the standard deviation, and ``10`` is the
-sample size of the distribution to be studied.
+sample size of the distribution to be studied. Several sample sizes can be
+studied in one run by separating them with commas
+
+.. sourcecode:: bash
+
+    pydev normal.py 1 2 10,100,1000
+
+in which case the results for each sample size are printed in turn.
 
 More advanced users should read the documentation of the 
 :class:`NormalDistribution` class in order to understand the public API of
 this object, should they wish to use it in their scripts.
 
-If imported into a script, there is no ``run`` method that needs to be called
-if a variable is updated, the sample is redrawn immediately after assignment.
-The averages and outputs will also automatically adapt.
+If imported into a script, the sample is drawn once, when the distribution is
+constructed. Distributions are immutable, so their parameters cannot be
+changed after construction. To study a distribution with different
+parameters, use :meth:`NormalDistribution.replace`, which returns a new
+distribution with a freshly drawn sample, and leaves the original untouched.
 
-.. warning::
-    If users are intending to use this library in a functional manner, purity
-    is guaranteed ONLY if the parameters are not changed.
+If only the averages are needed, and not the sample itself, use
+:meth:`NormalDistribution.statistics`. If `Numba <https://numba.pydata.org>`_
+is installed, this draws the sample and reduces it in a single compiled loop,
+without ever storing the sample. Otherwise, the sample is drawn and reduced
+in small chunks, so that memory use does not grow with the sample size.
 
-TODO: Implement some kind of asynchronicity when drawing new samples. Early
-    experiments were done but were unsuccessful due to a stack overflow
-    error caused by invoking ``__setattr__`` when wriiting results. Provide
-    each instance with a lock. Acquire and release this lock as necessary.
+If the optional C extension in ``_normal_c.pyx`` has been built, unseeded
+double precision samples are drawn and reduced by it in a single loop. See
+that module for how to build it.
+
+If `numexpr <https://github.com/pydata/numexpr>`_ is installed, very large
+samples are scaled and shifted in one multithreaded pass.
 """
 from collections import namedtuple
-from Scientific.IO import ArrayIO
-from Scientific.Statistics import mean
+from functools import lru_cache
 from sys import argv
-from numpy import random, multiply
+import numpy as np
+
+try:
+    from _normal_c import sample_and_reduce as _c_sample_and_reduce
+except ImportError:
+    _c_sample_and_reduce = None
+
+_NUMEXPR_MIN_SIZE = 2 ** 20
+_CHUNK_SIZE = 4096
+
+
+def _sample_and_reduce(mean, standard_deviation, sample_size, rng):
+    """
+    Draws ``sample_size`` samples from the normal distribution one at a time
+    using the generator ``rng``, and returns the average and the average of
+    the squares. No array is allocated for the sample. This is meant to be
+    compiled by :func:`_compiled_sample_and_reduce`.
+    """
+    sum_x = 0.0
+    sum_x2 = 0.0
+    for _ in range(sample_size):
+        x = mean + standard_deviation * rng.standard_normal()
+        sum_x += x
+        sum_x2 += x * x
+
+    return sum_x / sample_size, sum_x2 / sample_size
+
+
+@lru_cache(maxsize=None)
+def _compiled_sample_and_reduce():
+    """
+    Returns :func:`_sample_and_reduce` compiled with Numba, or ``None`` if
+    Numba is not installed. Numba is imported on first use rather than with
+    this module, so that it does not slow down start-up.
+    """
+    try:
+        from numba import njit
+    except ImportError:
+        return None
+
+    return njit(cache=True, fastmath=True)(_sample_and_reduce)
+
+
+@lru_cache(maxsize=None)
+def _numexpr():
+    """
+    Returns the numexpr module, or ``None`` if it is not installed. numexpr
+    is imported on first use rather than with this module, so that it does
+    not slow down start-up.
+    """
+    try:
+        import numexpr
+    except ImportError:
+        return None
+
+    return numexpr
+
+
+def _streaming_reduce(mean, standard_deviation, sample_size, seed=None):
+    """
+    Draws ``sample_size`` samples from the normal distribution in chunks of
+    at most ``_CHUNK_SIZE``, and returns the average and the average of the
+    squares. Each chunk is reduced as soon as it is drawn, and the same small
+    buffer is reused for every chunk, so it stays in cache and the full
+    sample is never stored.
+    """
+    rng = np.random.Generator(np.random.SFC64(seed))
+    buf = np.empty(min(sample_size, _CHUNK_SIZE), dtype=np.float64)
+
+    sum_x = 0.0
+    sum_x2 = 0.0
+    for start in range(0, sample_size, _CHUNK_SIZE):
+        chunk = buf[:min(_CHUNK_SIZE, sample_size - start)]
+        rng.standard_normal(out=chunk)
+        np.multiply(chunk, standard_deviation, out=chunk)
+        np.add(chunk, mean, out=chunk)
+
+        sum_x += float(chunk.sum())
+        sum_x2 += float(np.dot(chunk, chunk))
+
+    return sum_x / sample_size, sum_x2 / sample_size
 
 
-class NormalDistribution(object):
+def _variance(sample, mean_x):
+    """
+    Returns the variance of ``sample`` about its average ``mean_x``. The
+    deviations from the average are summed directly, rather than taking
+    ``<x^2> - <x>^2``, which cancels catastrophically when the mean is large
+    compared with the spread. The deviations are formed in double precision
+    in chunks of at most ``_CHUNK_SIZE``, so no temporary the size of the
+    sample is allocated. The second term corrects for rounding error in
+    ``mean_x``.
+    """
+    n = sample.size
+    if n == 0:
+        return float('nan')
+
+    buf = np.empty(min(n, _CHUNK_SIZE), dtype=np.float64)
+
+    sum_d = 0.0
+    sum_d2 = 0.0
+    for start in range(0, n, _CHUNK_SIZE):
+        chunk = sample[start:start + _CHUNK_SIZE]
+        deviations = np.subtract(
+            chunk, mean_x, out=buf[:chunk.size], dtype=np.float64
+        )
+
+        sum_d += float(deviations.sum())
+        sum_d2 += float(np.dot(deviations, deviations))
+
+    return (sum_d2 - sum_d ** 2 / n) / n
+
+
+class NormalDistribution:
     """
     Wraps the relevant functions to calculate the normal distribution, and
     makes this functionality available to other Python scripts through a 
@@ -60,21 +182,36 @@ class NormalDistribution(object):
         dist.sample_average
         dist.square_sample_average
         dist.output
+        dist.square_mean
+        dist.variance
 
         len(dist)
         dist[index]
+        iter(dist)
 
     The first property returns the average of the distribution. The second
     property returns the average of the squares. The third property yields
     a string representation of the results. When run from the command line,
-    this is printed to ``stdout``.
+    this is printed to ``stdout``. The last two properties return the square
+    of the average, and the variance of the sample.
 
     Calling ``len`` on this object returns the sample size, and indexing
     the object with a number will reutrn the sample corresponding to
-    ``index``.
+    ``index``. Iterating over the object yields each sample in turn.
+
+    Instances of this class are immutable. Assigning to any of their
+    attributes raises an ``AttributeError``. Use :meth:`replace` to get a
+    distribution with different parameters.
     """
+    __slots__ = (
+        '_mean', '_standard_deviation', '_sample_size', '_seed', '_dtype',
+        '_sample', '_mean_x', '_mean_x2', '_variance'
+    )
 
-    def __init__(self, mean, standard_deviation, sample_size):
+    def __init__(
+            self, mean, standard_deviation, sample_size, seed=None,
+            dtype=np.float64
+    ):
         """
         Initialize the NormalDistribution class. This class
         is responsible for calculating the required values from the normal
@@ -98,35 +235,113 @@ class NormalDistribution(object):
             distribution to be sampled
         :param int sample_size: The number of samples that will be drawn
             from the normal distribution
+        :param int seed: An optional seed for the random number generator.
+            Distributions built with the same parameters and seed draw the
+            same sample. If not given, fresh entropy is taken from the OS.
+        :param dtype: The floating point type of the sample, either
+            ``np.float64`` or ``np.float32``. Single precision halves the
+            memory taken by large samples. The averages are accumulated in
+            double precision either way.
+        :raises ValueError: If ``standard_deviation`` is negative, or if
+            ``dtype`` is not one of the above
 
         """
 
-        self.mean = mean
-        self.standard_deviation = standard_deviation
-        self.sample_size = sample_size
-        self.sample = None
+        if standard_deviation < 0:
+            raise ValueError(
+                'standard_deviation must be non-negative, not %s'
+                % standard_deviation
+            )
+
+        self._mean = mean
+        self._standard_deviation = standard_deviation
+        self._sample_size = sample_size
+        self._seed = seed
+        self._dtype = np.dtype(dtype)
+        if self._dtype not in (np.float32, np.float64):
+            raise ValueError(
+                'dtype must be np.float32 or np.float64, not %s' % self._dtype
+            )
 
+        (
+            self._sample, self._mean_x, self._mean_x2
+        ) = self._calculate_sample(seed)
+        self._variance = None
+
+    @property
+    def mean(self):
+        """
+        Returns the mean of the distribution
+        """
+        return self._mean
+
+    @property
+    def standard_deviation(self):
+        """
+        Returns the standard deviation of the distribution
+        """
+        return self._standard_deviation
+
+    @property
+    def sample_size(self):
+        """
+        Returns the number of samples drawn from the distribution
+        """
+        return self._sample_size
+
+    @property
+    def seed(self):
+        """
+        Returns the seed the sample was drawn with, or ``None`` if it was not
+        seeded
+        """
+        return self._seed
+
+    @property
+    def dtype(self):
+        """
+        Returns the floating point type of the sample
+        """
+        return self._dtype
+
+    @property
+    def sample(self):
+        """
+        Returns the sample drawn from the distribution
+        """
+        return self._sample
 
     @property
     def sample_average(self):
         """
         Returns the average of the sample drawn from the distribution
         """
-        if self.sample is None:
-            return None
-        else:
-            return mean(self.sample)
+        return self._mean_x
 
     @property
     def square_sample_average(self):
         """
         Returns the average of the squares.
         """
-        if self.sample is None:
-            return None
-        else:
-            x2 = multiply(self.sample, self.sample)
-            return mean(x2)
+        return self._mean_x2
+
+    @property
+    def square_mean(self):
+        """
+        Returns the square of the average.
+        """
+        return self._mean_x ** 2
+
+    @property
+    def variance(self):
+        """
+        Returns the variance of the sample. It is computed the first time it
+        is read, and cached.
+        """
+        if self._variance is None:
+            self._variance = _variance(self._sample, self._mean_x)
+
+        return self._variance
     
     @property
     def output(self):
@@ -134,24 +349,130 @@ class NormalDistribution(object):
         Write a string representation of the square of the average
         and the average of the squares
         """
-        return 'output <x^2>= %s \n output <x>= %s' % (
-            self.square_sample_average, self.sample_average
+        mean_x2, mean_x = self._mean_x2, self._mean_x
+        return f'output <x^2>= {mean_x2} \n output <x>= {mean_x}'
+
+    def replace(self, **kwargs):
+        """
+        Returns a new distribution with the same parameters as this one,
+        except for those given as keyword arguments. The new distribution
+        draws its own sample. If this distribution was seeded, the new one is
+        drawn with the same seed unless ``seed`` is given.
+
+        .. sourcecode:: python
+
+            dist = dist.replace(mean=1)
+
+        :param kwargs: Any of ``mean``, ``standard_deviation``,
+            ``sample_size``, ``seed``, and ``dtype``
+        :return: A new distribution with the updated parameters
+        :rtype: NormalDistribution
+        """
+        parameters = dict(
+            mean=self.mean, standard_deviation=self.standard_deviation,
+            sample_size=self.sample_size, seed=self.seed, dtype=self.dtype
         )
+        parameters.update(kwargs)
 
-    def _calculate_sample(self):
+        return NormalDistribution(**parameters)
+
+    @classmethod
+    def statistics(cls, mean, standard_deviation, sample_size, seed=None):
         """
-        Responsible for updating the sample when a property has been
-        changed. The use of the underscore before this method implies
+        Returns the average and the average of the squares of a sample drawn
+        from the normal distribution, without keeping the sample.
+
+        .. sourcecode:: python
+
+            averages = NormalDistribution.statistics(0, 1, 10000000)
+
+        If Numba is installed, the sample is drawn and reduced in a single
+        compiled loop, and is never stored. Without Numba, the sample is
+        drawn and reduced in chunks of a few thousand values, so memory use
+        stays constant however large the sample is. Either way, each call
+        draws from its own generator, so a given ``seed`` gives the same
+        averages with or without Numba. If ``sample_size`` is zero, both
+        averages are ``nan``.
+
+        :param float mean: The mean of the distribution to be sampled
+        :param float standard_deviation: The standard deviation of the
+            distribution to be sampled
+        :param int sample_size: The number of samples that will be drawn
+        :param int seed: An optional seed for the random number generator
+        :return: The average, and the average of the squares
+        :rtype: tuple
+        :raises ValueError: If ``standard_deviation`` is negative
+        """
+        if standard_deviation < 0:
+            raise ValueError(
+                'standard_deviation must be non-negative, not %s'
+                % standard_deviation
+            )
+
+        sample_size = int(sample_size)
+        if sample_size == 0:
+            return float('nan'), float('nan')
+
+        sample_and_reduce = _compiled_sample_and_reduce()
+        if sample_and_reduce is not None:
+            return sample_and_reduce(
+                float(mean), float(standard_deviation), sample_size,
+                np.random.Generator(np.random.SFC64(seed))
+            )
+
+        return _streaming_reduce(
+            mean, standard_deviation, sample_size, seed=seed
+        )
+
+    def _calculate_sample(self, seed):
+        """
+        Responsible for drawing the sample when the distribution is
+        constructed. The use of the underscore before this method implies
         that it is a private method, and is not meant to be used in the
         public API.
+
+        Returns a tuple of the new sample, its average, and the average of
+        its squares.
         """
-        sample = random.normal(
-            self.mean, self.standard_deviation, self.sample_size
-        )
+        rng = np.random.Generator(np.random.SFC64(seed))
+        sample = np.empty(int(self.sample_size), dtype=self.dtype)
+        if (
+            _c_sample_and_reduce is not None and seed is None
+            and sample.dtype == np.float64
+        ):
+            sample, mean_x, mean_x2 = _c_sample_and_reduce(
+                rng.bit_generator, self.mean, self.standard_deviation,
+                sample
+            )
+            return sample, mean_x, mean_x2
+
+        rng.standard_normal(out=sample, dtype=self.dtype)
+        numexpr = _numexpr() if sample.size >= _NUMEXPR_MIN_SIZE else None
+        if numexpr is not None and numexpr.get_num_threads() > 1:
+            numexpr.evaluate(
+                'mean + standard_deviation * sample', out=sample,
+                local_dict=dict(
+                    mean=sample.dtype.type(self.mean),
+                    standard_deviation=sample.dtype.type(
+                        self.standard_deviation
+                    ),
+                    sample=sample
+                )
+            )
+        else:
+            np.multiply(sample, self.standard_deviation, out=sample)
+            np.add(sample, self.mean, out=sample)
 
-        assert len(sample) == self.sample_size
+        n = sample.size
+        mean_x = float(sample.sum(dtype=np.float64)/n)
+        if sample.dtype == np.float64:
+            mean_x2 = float(np.dot(sample, sample)/n)
+        else:
+            mean_x2 = float(
+                np.einsum('i,i->', sample, sample, dtype=np.float64)/n
+            )
 
-        return sample
+        return sample, mean_x, mean_x2
     
 
     def __len__(self):
@@ -164,33 +485,19 @@ class NormalDistribution(object):
     def __getitem__(self, index):
         """
         Allows indexing of each sample in the distribution sampled from this
-        object. This, combined with the ``__len__`` method, also makes this 
-        object iterable, just like a list.
-        """
-        return self.sample[index]
-
-    @property
-    def _should_update(self):
+        object. Since the sample is a numpy array, slices such as
+        ``dist[10:20]`` are also supported, and return a view of the sample
+        rather than a copy.
         """
-        Helper method used by ``__setattr__`` to determine if the sample
-        should be redrawn.
-        """
-        return all(
-            (hasattr(self, attr) for attr in 
-                ('mean', 'standard_deviation', 'sample_size')
-            )
-        )
+        return self._sample[index]
 
-    def __setattr__(self, name, value):
+    def __iter__(self):
         """
-        This method overwrites attribute assignment. It is never called
-        directly, but is instead invoked when the ``.`` operator is performed
-        on an instance of this object. On assignment, the sample is redrawn. 
+        Iterates over the sample, just like a list. This hands iteration off
+        to the sample array directly, instead of indexing this object once
+        per element.
         """
-        self.__dict__[name] = value
- 
-        if self._should_update:
-            self.__dict__['sample'] = self._calculate_sample()
+        return iter(self._sample)
 
     def __repr__(self):
         """
@@ -203,16 +510,20 @@ class NormalDistribution(object):
         
 if __name__ == '__main__':
 
-    Input = namedtuple("Input", ["mean", "standard_deviation", "sample_size"])
+    Input = namedtuple("Input", ["mean", "standard_deviation", "sample_sizes"])
 
     if len(argv)!=4:
-        print('usage: pydev %s <mean> <standard deviation> <# of samples>' % argv[0])
+        print('usage: pydev %s <mean> <standard deviation> <# of samples>[,<# of samples>...]' % argv[0])
         exit()
 
-    user_input = Input(float(argv[1]), float(argv[2]), float(argv[3]))
-    distribution = NormalDistribution(
-        user_input.mean, user_input.standard_deviation, user_input.sample_size
+    user_input = Input(
+        float(argv[1]), float(argv[2]), [int(n) for n in argv[3].split(',')]
     )
 
-    print(distribution.output)
+    for sample_size in user_input.sample_sizes:
+        distribution = NormalDistribution(
+            user_input.mean, user_input.standard_deviation, sample_size
+        )
+
+        print(distribution.output)
 
@@ -2,23 +2,35 @@
 Contains unit tests for :mod:`normal.py`
 """
 import unittest
-from Scientific.IO import ArrayIO
-from normal import NormalDistribution, mean
-from numpy.testing import assert_equal
+from unittest import mock
+import numpy as np
+import normal
+from normal import (
+    NormalDistribution, _streaming_reduce, _CHUNK_SIZE, _c_sample_and_reduce
+)
+from numpy.testing import (
+    assert_equal, assert_almost_equal, assert_array_equal
+)
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
 class TestNormalDistribution(unittest.TestCase):
     """
     Base class for unit tests for :mod:`normal.py`
     """
-    def setUp(self):
+    @classmethod
+    def setUpClass(cls):
         """
         Set up the unit test for the constructor, picking the
         Z distribution as a test, and a relatively representative
         sample of the normal distribution
         """
-        self.mean = 0
-        self.standard_deviation = 1
-        self.sample_size = 30
+        cls.mean = 0
+        cls.standard_deviation = 1
+        cls.sample_size = 30
 
 class TestNormalDistributionConstructor(TestNormalDistribution):
     def test_constructor(self):
@@ -30,33 +42,110 @@ class TestNormalDistributionConstructor(TestNormalDistribution):
         self.assertEqual(self.standard_deviation, dist.standard_deviation)
         self.assertEqual(self.sample_size, dist.sample_size)
 
+    def test_constructor_seed(self):
+        dist1 = NormalDistribution(
+            self.mean, self.standard_deviation, self.sample_size, seed=1234
+        )
+        dist2 = NormalDistribution(
+            self.mean, self.standard_deviation, self.sample_size, seed=1234
+        )
+
+        assert_array_equal(dist1.sample, dist2.sample, strict=True)
+
+    def test_constructor_float32(self):
+        dist = NormalDistribution(
+            self.mean, self.standard_deviation, self.sample_size,
+            dtype=np.float32
+        )
+
+        self.assertEqual(np.float32, dist.dtype)
+        self.assertEqual(np.float32, dist.sample.dtype)
+        assert_almost_equal(
+            (dist.sample.astype(np.float64) ** 2).mean(),
+            dist.square_sample_average
+        )
+
+    def test_constructor_bad_dtype(self):
+        with self.assertRaises(ValueError):
+            NormalDistribution(
+                self.mean, self.standard_deviation, self.sample_size,
+                dtype=np.float16
+            )
+
+    def test_constructor_negative_standard_deviation(self):
+        with self.assertRaises(ValueError):
+            NormalDistribution(self.mean, -1, self.sample_size)
+
+    def test_constructor_seed_uses_numpy(self):
+        """
+        Tests that a seeded sample is the one numpy draws from the same seed,
+        whether or not the C extension is built.
+        """
+        dist = NormalDistribution(1, 2, self.sample_size, seed=1234)
+        rng = np.random.Generator(np.random.SFC64(1234))
+
+        assert_almost_equal(
+            1 + 2 * rng.standard_normal(self.sample_size), dist.sample
+        )
+
 class TestNormalDistributionWithFixture(TestNormalDistribution):
-    def setUp(self):
-        TestNormalDistribution.setUp(self)
-        self.dist = NormalDistribution(
-            self.mean, self.standard_deviation, self.sample_size
+    @classmethod
+    def setUpClass(cls):
+        """
+        Draw one seeded distribution shared by every test in the class.
+        Distributions are immutable, so no test can disturb it for the
+        others.
+        """
+        super().setUpClass()
+        cls.dist = NormalDistribution(
+            cls.mean, cls.standard_deviation, cls.sample_size, seed=1234
         )
 
 class TestNormalDistributionSampling(TestNormalDistributionWithFixture):
     def test_sample_purity(self):
-        sample1 = self.dist.sample
-        sample2 = self.dist.sample
-        assert_equal(sample1, sample2)
+        self.assertIs(self.dist.sample, self.dist.sample)
 
-    def test_sample_average_is_none(self):
-        self.dist.__dict__['sample'] = None
-        self.assertIsNone(self.dist.sample_average)
+    def test_sample_dtype(self):
+        self.assertEqual(np.float64, self.dist.dtype)
+        self.assertEqual(np.float64, self.dist.sample.dtype)
+        self.assertEqual((self.sample_size,), self.dist.sample.shape)
 
-    def test_sample_average_not_none(self):
-        assert_equal(mean(self.dist.sample), self.dist.sample_average)
-
-    def test_sample_square_average_is_none(self):
-        self.dist.__dict__['sample'] = None
-        self.assertIsNone(self.dist.square_sample_average)
+    def test_sample_average(self):
+        assert_almost_equal(self.dist.sample.mean(), self.dist.sample_average)
 
     def test_sample_square_average(self):
         sample = self.dist.sample
-        assert_equal(mean(sample * sample), self.dist.square_sample_average)
+        assert_almost_equal(
+            (sample * sample).mean(), self.dist.square_sample_average
+        )
+
+    def test_square_mean(self):
+        assert_almost_equal(
+            self.dist.sample.mean() ** 2, self.dist.square_mean
+        )
+
+    def test_variance(self):
+        assert_almost_equal(self.dist.sample.var(), self.dist.variance)
+
+    def test_variance_large_mean(self):
+        """
+        Tests that the variance stays accurate when the mean is much larger
+        than the standard deviation, where ``<x^2> - <x>^2`` would cancel.
+        """
+        dist = NormalDistribution(1e8, 1, 1000, seed=3)
+        assert_almost_equal(dist.sample.var(), dist.variance)
+
+    def test_variance_multiple_chunks(self):
+        """
+        Tests the variance over a sample spanning several chunks, the last
+        of them partial, in single precision.
+        """
+        dist = NormalDistribution(
+            1e4, 2, 3 * _CHUNK_SIZE + 1, seed=3, dtype=np.float32
+        )
+        assert_almost_equal(
+            dist.sample.astype(np.float64).var(), dist.variance
+        )
 
     def test_len(self):
         self.assertEqual(self.dist.sample_size, len(self.dist))
@@ -64,30 +153,57 @@ class TestNormalDistributionSampling(TestNormalDistributionWithFixture):
     def test_getitem(self):
         assert_equal(self.dist[0], self.dist.sample[0])
 
-    def test_setattr(self):
+    def test_getitem_slice(self):
+        assert_array_equal(
+            self.dist[10:20], self.dist.sample[10:20], strict=True
+        )
+
+    def test_iter(self):
+        assert_array_equal(
+            np.array(list(self.dist)), self.dist.sample, strict=True
+        )
+
+    def test_replace(self):
         """
-        Tests that when an attribute of the normal distribution is set,
-        the new simulation parameters are recalculated immediately after
-        being set. The old and new arrays should not be equal, and so the
-        equality function should throw an AssertionError. This checks that this
-        error was thrown.
+        Tests that replacing a parameter of the normal distribution returns a
+        new distribution with a freshly drawn sample. The old and new arrays
+        should not be equal, and so the equality function should throw an
+        AssertionError. This checks that this error was thrown.
         """
-        old_sample = self.dist.sample
-
-        self.dist.mean = 1
+        new_dist = self.dist.replace(mean=1)
 
-        new_sample = self.dist.sample
+        self.assertEqual(1, new_dist.mean)
+        self.assertEqual(self.standard_deviation, new_dist.standard_deviation)
+        self.assertEqual(self.sample_size, new_dist.sample_size)
 
         with self.assertRaises(AssertionError):
-            assert_equal(old_sample, new_sample)
+            assert_array_equal(self.dist.sample, new_dist.sample)
+
+    def test_replace_keeps_seed(self):
+        new_dist = self.dist.replace(mean=1)
+        expected = NormalDistribution(
+            1, self.standard_deviation, self.sample_size, seed=1234
+        )
 
-class TestShouldUpdate(TestNormalDistributionWithFixture):
-    def test_should_update_true(self):
-        self.assertTrue(self.dist._should_update)
+        self.assertEqual(1234, new_dist.seed)
+        assert_array_equal(expected.sample, new_dist.sample, strict=True)
 
-    def test_should_update_false(self):
-        del self.dist.mean
-        self.assertFalse(self.dist._should_update)
+    def test_replace_leaves_original(self):
+        old_sample = self.dist.sample.copy()
+
+        self.dist.replace(mean=1)
+
+        self.assertEqual(self.mean, self.dist.mean)
+        assert_array_equal(old_sample, self.dist.sample, strict=True)
+
+class TestImmutability(TestNormalDistributionWithFixture):
+    def test_setattr_raises(self):
+        with self.assertRaises(AttributeError):
+            self.dist.mean = 1
+
+    def test_new_attribute_raises(self):
+        with self.assertRaises(AttributeError):
+            self.dist.foo = 1
 
 class TestSampleOutput(TestNormalDistributionWithFixture):
     def test_output(self):
@@ -97,6 +213,123 @@ class TestSampleOutput(TestNormalDistributionWithFixture):
 
         self.assertEqual(expected_output, self.dist.output)
 
+class TestStatistics(TestNormalDistribution):
+    def test_statistics_seed(self):
+        statistics1 = NormalDistribution.statistics(
+            self.mean, self.standard_deviation, self.sample_size, seed=1234
+        )
+        statistics2 = NormalDistribution.statistics(
+            self.mean, self.standard_deviation, self.sample_size, seed=1234
+        )
+
+        self.assertEqual(statistics1, statistics2)
+
+    def test_statistics_values(self):
+        sample_average, square_sample_average = NormalDistribution.statistics(
+            1, 2, 100000, seed=1234
+        )
+
+        assert_almost_equal(1, sample_average, decimal=1)
+        assert_almost_equal(5, square_sample_average, decimal=1)
+
+    def test_statistics_matches_streaming_reduce(self):
+        """
+        Tests that a seeded call gives the same averages whichever path
+        is taken to compute them.
+        """
+        assert_almost_equal(
+            _streaming_reduce(1, 2, 10000, seed=1234),
+            NormalDistribution.statistics(1, 2, 10000, seed=1234)
+        )
+
+    def test_statistics_negative_standard_deviation(self):
+        with self.assertRaises(ValueError):
+            NormalDistribution.statistics(self.mean, -1, self.sample_size)
+
+    def test_statistics_empty_sample(self):
+        sample_average, square_sample_average = NormalDistribution.statistics(
+            self.mean, self.standard_deviation, 0
+        )
+
+        self.assertTrue(np.isnan(sample_average))
+        self.assertTrue(np.isnan(square_sample_average))
+
+class TestStreamingReduce(unittest.TestCase):
+    def test_streaming_reduce_values(self):
+        """
+        Tests the chunked reduction over a sample size that is not a
+        multiple of the chunk size, so that the last chunk is partial.
+        """
+        sample_average, square_sample_average = _streaming_reduce(
+            1, 2, 25 * _CHUNK_SIZE + 1, seed=1234
+        )
+
+        assert_almost_equal(1, sample_average, decimal=1)
+        assert_almost_equal(5, square_sample_average, decimal=1)
+
+    def test_streaming_reduce_small_sample(self):
+        sample_average, square_sample_average = _streaming_reduce(
+            3, 0, 10, seed=1234
+        )
+
+        assert_almost_equal(3, sample_average)
+        assert_almost_equal(9, square_sample_average)
+
+@unittest.skipUnless(_c_sample_and_reduce, 'C extension is not built')
+class TestCSampleAndReduce(unittest.TestCase):
+    def test_sample_and_reduce(self):
+        out = np.empty(1001)
+        sample, sample_average, square_sample_average = _c_sample_and_reduce(
+            np.random.SFC64(1234), 1, 2, out
+        )
+
+        self.assertTrue(np.shares_memory(out, sample))
+        assert_almost_equal(out.mean(), sample_average)
+        assert_almost_equal((out * out).mean(), square_sample_average)
+        assert_almost_equal(1, sample_average, decimal=0)
+        assert_almost_equal(5, square_sample_average, decimal=0)
+
+    def test_unseeded_distribution(self):
+        dist = NormalDistribution(1, 2, 1001)
+
+        assert_almost_equal(dist.sample.mean(), dist.sample_average)
+        assert_almost_equal(
+            (dist.sample * dist.sample).mean(), dist.square_sample_average
+        )
+        assert_almost_equal(dist.sample.var(), dist.variance)
+
+@unittest.skipUnless(numexpr, 'numexpr is not installed')
+class TestNumexpr(unittest.TestCase):
+    """
+    Forces the numexpr path, which is otherwise only taken for very large
+    samples on more than one thread.
+    """
+    def setUp(self):
+        self.num_threads = numexpr.set_num_threads(2)
+
+    def tearDown(self):
+        numexpr.set_num_threads(self.num_threads)
+
+    def assert_numexpr_sample(self, dtype):
+        with mock.patch.object(normal, '_NUMEXPR_MIN_SIZE', 0), \
+                mock.patch.object(
+                    numexpr, 'evaluate', wraps=numexpr.evaluate
+                ) as evaluate:
+            dist = NormalDistribution(1, 2, 1001, seed=1234, dtype=dtype)
+
+        evaluate.assert_called_once()
+        rng = np.random.Generator(np.random.SFC64(1234))
+        expected = 1 + 2 * rng.standard_normal(1001, dtype=dtype)
+
+        self.assertEqual(dtype, dist.sample.dtype)
+        assert_almost_equal(expected, dist.sample, decimal=5)
+
+    def test_numexpr_float64(self):
+        self.assert_numexpr_sample(np.float64)
+
+    def test_numexpr_float32(self):
+        self.assert_numexpr_sample(np.float32)
+
 class TestRepr(TestNormalDistributionWithFixture):
     def test_repr(self):
         self.assertIsNotNone(self.dist.__repr__())